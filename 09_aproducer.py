@@ -44,6 +44,8 @@ class QueueClosed(Exception):
 
 
 class Result:
+    __slots__ = ('value', 'exc')
+
     def __init__(self, value=None, exc=None):
         self.value = value
         self.exc = exc
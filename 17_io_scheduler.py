@@ -3,151 +3,1445 @@
 # An example of how to implement coroutine based concurrency layered
 # on top of a callback-based scheduler.
 
+import os
+import signal
+import sys
 import time
+import traceback
+import types
+import weakref
+from bisect import bisect_left
 from collections import deque
 import heapq
-from select import select
-from socket import socket, AF_INET, SOCK_STREAM
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+import select
+import selectors
+from socket import socket, socketpair, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, SO_REUSEPORT
+
+EVENT_READ = selectors.EVENT_READ
+EVENT_WRITE = selectors.EVENT_WRITE
+IOV_MAX = 1024  # Most buffers a single sendmsg() accepts on Linux
+
+
+# Pollers: keep the set of watched fds registered in the kernel between
+# loop iterations instead of handing select() two fresh sets every turn.
+# Interface: register/modify/unregister(fd, mask) and poll(timeout),
+# which returns a list of (fd, mask) pairs. modify() accepts an empty
+# mask: the fd leaves the kernel's set (so it can't even report a hangup)
+# until a later modify() with a non-empty mask brings it back.
+class SelectorPoller:
+    # Portable backend (epoll, kqueue, devpoll, poll or select)
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+
+    def register(self, fd, mask):
+        self._selector.register(fd, mask)
+
+    def modify(self, fd, mask):
+        registered = fd in self._selector.get_map()
+        if not mask:
+            if registered:
+                self._selector.unregister(fd)  # selectors refuse an empty mask
+        elif registered:
+            self._selector.modify(fd, mask)
+        else:
+            self._selector.register(fd, mask)
+
+    def unregister(self, fd):
+        if fd in self._selector.get_map():
+            self._selector.unregister(fd)
+
+    def poll(self, timeout):
+        return [(key.fd, mask) for key, mask in self._selector.select(timeout)]
+
+    def close(self):
+        self._selector.close()
+
+
+class EpollPoller:
+    # Linux epoll. With edge_triggered=True the kernel only reports
+    # transitions, so whoever gets woken must drain the fd (until
+    # BlockingIOError) or it will not be reported again.
+    def __init__(self, edge_triggered=False):
+        self._epoll = select.epoll()
+        self._flags = select.EPOLLET if edge_triggered else 0
+        self.edge_triggered = edge_triggered
+
+    def _events(self, mask):
+        events = self._flags
+        if mask & EVENT_READ:
+            events |= select.EPOLLIN
+        if mask & EVENT_WRITE:
+            events |= select.EPOLLOUT
+        return events
+
+    def register(self, fd, mask):
+        self._epoll.register(fd, self._events(mask))
+
+    def modify(self, fd, mask):
+        try:
+            if not mask:
+                self._epoll.unregister(fd)  # Would still report HUP/ERR
+            else:
+                self._epoll.modify(fd, self._events(mask))
+        except FileNotFoundError:
+            if mask:
+                self._epoll.register(fd, self._events(mask))
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        ready = []
+        for fd, events in self._epoll.poll(timeout):
+            mask = 0
+            if events & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                mask |= EVENT_READ
+            if events & (select.EPOLLOUT | select.EPOLLHUP | select.EPOLLERR):
+                mask |= EVENT_WRITE
+            ready.append((fd, mask))
+        return ready
+
+    def close(self):
+        self._epoll.close()
+
+
+def default_poller():
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    return SelectorPoller()
+
+
+def _fileno(fileobj):
+    return fileobj if isinstance(fileobj, int) else fileobj.fileno()
+
+
+def _weak(fileobj, callback):
+    # Scheduler._registered only holds file objects weakly: a socket
+    # dropped without unregister() still gets collected (and closed)
+    if isinstance(fileobj, int):
+        return lambda: fileobj
+    return weakref.ref(fileobj, callback)
+
+
+class Waker:
+    # Lets other threads interrupt a blocking poll(): an eventfd on Linux,
+    # a socketpair elsewhere. wake() skips the syscall while a wakeup is
+    # already pending; clear() re-enables it (call before looking at
+    # whatever the other threads queued, or a wakeup could get lost).
+    def __init__(self):
+        self._pending = False
+        if hasattr(os, 'eventfd'):
+            self._fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+            self._sockets = None
+        else:
+            self._sockets = socketpair()
+            for sock in self._sockets:
+                sock.setblocking(False)
+            self._fd = self._sockets[0].fileno()
+
+    def fileno(self):
+        return self._fd
+
+    def wake(self):
+        if self._pending:
+            return
+        self._pending = True
+        try:
+            if self._sockets is None:
+                os.eventfd_write(self._fd, 1)
+            else:
+                self._sockets[1].send(b'\0')
+        except BlockingIOError:
+            pass  # Counter/pipe full: a wakeup is pending regardless
+
+    def clear(self):
+        self._pending = False
+        try:
+            if self._sockets is None:
+                os.eventfd_read(self._fd)
+            else:
+                while self._sockets[0].recv(4096):
+                    pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        if self._sockets is None:
+            os.close(self._fd)
+        else:
+            for sock in self._sockets:
+                sock.close()
+
+
+# Timers. Deadlines are Scheduler.clock() values (time.monotonic() by
+# default). A timer store offers
+# add(deadline, func) -> Timer, remove(timer), next_deadline() and
+# expire(now, ready), which appends every due func to ready and returns
+# the earliest deadline among them (None if nothing was due). len()
+# counts live timers only. Fired and removed timers have func set to None.
+class Timer:
+    # Handle returned by call_later()
+    __slots__ = ('_store', 'deadline', 'func')
+
+    def __init__(self, store, deadline, func):
+        self._store = store
+        self.deadline = deadline
+        self.func = func
+
+    def cancel(self):
+        # Drop the callback (and whatever it holds on to) right away.
+        # Does nothing if the timer already fired or was cancelled.
+        if self.func is not None:
+            if self._store is None:
+                self.func = None  # Sitting in ready, see __call__
+            else:
+                self._store.remove(self)
+
+    def active(self):
+        return self.func is not None
+
+    def __call__(self):
+        # Timers already due when added skip the store: call_at() puts
+        # them straight into ready as themselves, still cancellable
+        func, self.func = self.func, None
+        if func is not None:
+            func()
+
+
+class TimerHeap:
+    # Binary heap of (deadline, sequence, timer): O(log n) add/expire.
+    # remove() only tombstones the entry, so cancelling is O(1); the heap
+    # gets rebuilt once tombstones make up more than half of it.
+    COMPACT_MIN = 64
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = 0
+        self._cancelled = 0  # Tombstones still in the heap
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def add(self, deadline, func):
+        timer = Timer(self, deadline, func)
+        self._sequence += 1
+        heapq.heappush(self._heap, (deadline, self._sequence, timer))
+        return timer
+
+    def remove(self, timer):
+        if timer.func is None:
+            return
+        timer.func = None
+        self._cancelled += 1
+        if self._cancelled > self.COMPACT_MIN and self._cancelled * 2 > len(self._heap):
+            self._heap = [entry for entry in self._heap if entry[2].func is not None]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+    def next_deadline(self):
+        heap = self._heap
+        while heap and heap[0][2].func is None:
+            heapq.heappop(heap)
+            self._cancelled -= 1
+        return heap[0][0] if heap else None
+
+    def expire(self, now, ready):
+        heap = self._heap
+        earliest = None
+        while heap and heap[0][0] <= now:
+            timer = heapq.heappop(heap)[2]
+            if timer.func is None:
+                self._cancelled -= 1
+                continue
+            if earliest is None:
+                earliest = timer.deadline
+            ready.append(timer.func)
+            timer.func = None
+        return earliest
+
+
+class BufferPool:
+    # Recycles fixed-size bytearrays so handlers can recv_into() them
+    # without allocating a new bytes object per message
+    def __init__(self, size=65536, maxfree=64):
+        self.size = size
+        self.maxfree = maxfree  # Free buffers kept around at most
+        self._free = []
+
+    def acquire(self):
+        return self._free.pop() if self._free else bytearray(self.size)
+
+    def release(self, buffer):
+        if len(self._free) < self.maxfree:
+            self._free.append(buffer)
+
+
+class VirtualClock:
+    # Simulated time for Scheduler(clock=VirtualClock()). It only moves
+    # when advanced, and the loop advances it straight to the next
+    # deadline whenever timers are all it is waiting for. A day of
+    # call_later() retries and backoff plays out in milliseconds.
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, delay):
+        if delay > 0:
+            self.now += delay
+
+
+class LoopProfiler:
+    # Where the loop's time goes. Set Scheduler.profiler to one of these
+    # (any time, also None to switch it off again); while it is None the
+    # loop runs uninstrumented. Times are time.perf_counter() seconds
+    # spent running, whatever the scheduler's clock.
+    LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)  # Upper bounds; then +inf
+
+    def __init__(self, slow_callback=0.1, top=10):
+        self.slow_callback = slow_callback  # Warn about callbacks running this long
+        self.top = top  # Live tasks listed in snapshot()
+        self.reset()
+
+    def reset(self):
+        self.iterations = 0
+        self.callbacks = 0
+        self.busy = 0.0
+        self.slow = 0
+        # Weak ref to a live task -> [calls, seconds, longest, name]. A
+        # task collected without finishing gets merged into by_name too.
+        self._tasks = {}
+        self._by_name = {}  # Callback or coroutine name -> [calls, seconds, longest]
+        self._lag = [0] * (len(self.LAG_BUCKETS) + 1)
+        self._lag_sum = 0.0
+        self._lag_max = 0.0
+
+    def run(self, queue, budget):
+        # Scheduler.run()'s inner loop, timing every callback
+        clock = time.perf_counter
+        tasks = self._tasks
+        slow = self.slow_callback
+        calls = 0
+        start = end = clock()
+        while queue and calls < budget:
+            func = queue.popleft()
+            if type(func) is Timer:
+                # Due when added (see call_at()): book the time under the
+                # task or callback it wraps
+                timer, func = func, func.func
+                timer()
+            else:
+                func()
+            begin, end = end, clock()
+            elapsed = end - begin
+            calls += 1
+            if func is None:
+                continue  # Cancelled before its turn came
+            if type(func) is Task:
+                key = weakref.ref(func)
+                stats = tasks.get(key)
+                if stats is None:
+                    key = weakref.ref(func, self._collected)
+                    stats = tasks[key] = [0, 0.0, 0.0, func.coro.__qualname__]
+            else:
+                stats = self._named(getattr(func, '__qualname__', type(func).__qualname__))
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed > stats[2]:
+                stats[2] = elapsed
+            if elapsed >= slow:
+                self._slow(func, elapsed)
+            if type(func) is Task and func.done:
+                del tasks[key]
+                self._merge(self._named(stats[3]), stats)
+        self.iterations += 1
+        self.callbacks += calls
+        self.busy += end - start
+
+    def _collected(self, key):
+        stats = self._tasks.pop(key, None)
+        if stats is not None:
+            self._merge(self._named(stats[3]), stats)
+
+    def _slow(self, func, elapsed):
+        self.slow += 1
+        if type(func) is Task:
+            func = func.coro
+        print(f'Slow callback took {elapsed:.3f}s: {func!r}', file=sys.stderr)
+
+    def _named(self, name):
+        stats = self._by_name.get(name)
+        if stats is None:
+            stats = self._by_name[name] = [0, 0.0, 0.0]
+        return stats
+
+    @staticmethod
+    def _merge(total, stats):
+        total[0] += stats[0]
+        total[1] += stats[1]
+        total[2] = max(total[2], stats[2])
+
+    def lag(self, late):
+        # How long after its deadline the loop got round to a timer
+        self._lag[bisect_left(self.LAG_BUCKETS, late)] += 1
+        self._lag_sum += late
+        if late > self._lag_max:
+            self._lag_max = late
+
+    def snapshot(self):
+        # Plain dicts and numbers, ready for a metrics pipeline
+        by_name = {name: list(stats) for name, stats in self._by_name.items()}
+        tasks = [(key(), stats) for key, stats in list(self._tasks.items())]
+        tasks = [(task, stats) for task, stats in tasks if task is not None]
+        for task, stats in tasks:
+            self._merge(by_name.setdefault(stats[3], [0, 0.0, 0.0]), stats)
+        top = sorted(tasks, key=lambda item: item[1][1], reverse=True)[:self.top]
+        return {
+            'iterations': self.iterations,
+            'callbacks': self.callbacks,
+            'busy_seconds': self.busy,
+            'slow_callbacks': self.slow,
+            'lag': {
+                'count': sum(self._lag),
+                'sum': self._lag_sum,
+                'max': self._lag_max,
+                'buckets': dict(zip([*map(str, self.LAG_BUCKETS), 'inf'], self._lag)),
+            },
+            'by_name': {name: {'calls': calls, 'seconds': seconds, 'longest': longest}
+                        for name, (calls, seconds, longest) in by_name.items()},
+            'top_tasks': [{'task': repr(task.coro), 'calls': calls, 'seconds': seconds, 'longest': longest}
+                          for task, (calls, seconds, longest, name) in top],
+        }
+
+
+class _RunGroup:
+    __slots__ = ('name', 'weight', 'queue')
+
+    def __init__(self, name, weight):
+        self.name = name
+        self.weight = weight
+        self.queue = deque()
 
 
 # Callback based scheduler (from earlier)
 class Scheduler:
-    def __init__(self):
+    def __init__(self, poller=None, timers=None, clock=None, profiler=None):
+        # clock() returns the current time in seconds. A clock with an
+        # advance(delay) method (VirtualClock) is simulated: see run().
+        self.profiler = profiler  # LoopProfiler, or None
+        self.clock = clock if clock is not None else time.monotonic
+        self._advance = getattr(clock, 'advance', None)
         self.ready = deque()  # Functions ready to execute
-        self.sleeping = []  # Sleeping functions
-        self.sequence = 0
-        self.current = None
+        if timers is None:
+            timers = TimerHeap()
+        self.sleeping = timers  # Sleeping functions
+        self.timer_slack = 0.0  # Timers may fire up to this late, see call_at()
         self._read_waiting = {}
         self._write_waiting = {}
+        self._poller = poller if poller is not None else default_poller()
+        self._edge_triggered = getattr(self._poller, 'edge_triggered', False)
+        # fd -> [weak fileobj, interest mask, readiness nobody was waiting for]
+        self._registered = {}
+        self._executor = None  # Thread pool for run_in_executor()
+        self._process_pool = None  # Process pool for run_in_process()
+        self.process_limit = 2 * (os.cpu_count() or 1)  # run_in_process() calls in flight
+        self._in_process = 0
+        self._process_waiting = deque()  # Tasks waiting for a process slot
+        self._jobs = 0  # Executor jobs still running
+        self._tasks = weakref.WeakSet()  # Live tasks, for task_states()
+        self.budget = 1000  # Most callbacks run between two I/O polls
+        self._groups = {}  # Fair-share run queues, see add_group()
+        self._queued = 0  # Callbacks held back in group queues
+        self._from_threads = deque()  # Callbacks handed over by other threads
+        # Polled outside _registered: it must not keep run() going by itself
+        self._waker = Waker()
+        self._poller.register(self._waker.fileno(), EVENT_READ)
+        # Trap requests yielded by tasks -> handler(task, trap)
+        self._traps = {
+            'current': self._trap_current,
+            'sleep': self._trap_sleep,
+            'read_wait': self._trap_read_wait,
+            'write_wait': self._trap_write_wait,
+            'park': self._trap_park,
+            'future': self._trap_future,
+        }
 
     def call_soon(self, func):
         self.ready.append(func)
 
+    def call_soon_threadsafe(self, func):
+        # The one method other threads may call. Wakes up a blocked poll().
+        # Callbacks arriving after run() returned wait for the next run().
+        self._from_threads.append(func)  # deque.append is atomic
+        self._waker.wake()
+
     def call_later(self, delay, func):
-        self.sequence += 1
-        deadline = time.time() + delay  # Expiration time
-        # Priority queue
-        heapq.heappush(self.sleeping, (deadline, self.sequence, func))
+        deadline = self.clock() + delay  # Expiration time
+        return self.call_at(deadline, func)  # Timer, can be cancel()ed
+
+    def call_at(self, deadline, func):
+        if deadline <= self.clock():
+            # Already due: run on this pass, no need to go through the store
+            timer = Timer(None, deadline, func)
+            self.ready.append(timer)
+            return timer
+        slack = self.timer_slack
+        if slack:
+            # Round up onto the slack grid: never early, and timers due
+            # within the same slack window share one wakeup
+            rounded = -(-deadline // slack) * slack
+            deadline = rounded if rounded >= deadline else rounded + slack
+        return self.sleeping.add(deadline, func)
 
     def read_wait(self, fileno, func):
         # Trigger func() when fileno is readable
-        self._read_waiting[fileno] = func
+        self._wait(fileno, EVENT_READ, self._read_waiting, func)
 
     def write_wait(self, fileno, func):
         # Trigger func() when fileno is writeable
-        self._write_waiting[fileno] = func
+        self._wait(fileno, EVENT_WRITE, self._write_waiting, func)
+
+    def _wait(self, fileobj, event, waiting, func):
+        # An fd stays registered for its lifetime. The interest mask only
+        # widens here and narrows in run() when an event finds nobody
+        # waiting, so a chatty socket costs no register/modify per message.
+        fd = _fileno(fileobj)
+        reg = self._registered.get(fd)
+        if reg is None or reg[0]() != fileobj:
+            if reg is not None:
+                self._forget(fd)  # Closed without unregister(), fd reused
+            ref = _weak(fileobj, lambda ref: self._collected(fd, ref))
+            reg = self._registered[fd] = [ref, event, 0]
+            self._poller.register(fd, event)
+        elif reg[2] & event:
+            # Edge-triggered: readiness already reported, nobody was waiting
+            reg[2] &= ~event
+            self.ready.append(func)
+            return
+        elif not reg[1] & event:
+            reg[1] |= event
+            self._poller.modify(fd, reg[1])
+        waiting[fd] = func
+
+    def unregister(self, fileno):
+        # Drop fileno from the poller for good. Call before closing it.
+        fd = _fileno(fileno)
+        self._read_waiting.pop(fd, None)
+        self._write_waiting.pop(fd, None)
+        if fd in self._registered:
+            self._forget(fd)
+
+    def _collected(self, fd, ref):
+        # A registered file object was garbage collected without
+        # unregister(). Closing it took the fd out of the kernel's set.
+        reg = self._registered.get(fd)
+        if reg is not None and reg[0] is ref:
+            self.unregister(fd)
+
+    def _forget(self, fd):
+        del self._registered[fd]
+        try:
+            self._poller.unregister(fd)
+        except OSError:
+            pass  # Kernel already dropped it along with the closed fd
 
     def run(self):
-        while self.ready or self.sleeping or self._read_waiting or self._write_waiting:
-            if not self.ready:
-                # Find the nearest deadline
-                if self.sleeping:
-                    deadline, _, func = self.sleeping[0]
-                    timeout = deadline - time.time()
-                    if timeout < 0:
-                        timeout = 0
-                else:
-                    timeout = None  # Wait forever
-
-                # Wait fo I/O (and sleep)
-                can_read, can_write, _ = select(
-                    self._read_waiting, self._write_waiting, [], timeout
-                )
-                for fd in can_read:
-                    self.ready.append(self._read_waiting.pop(fd))
-                for fd in can_write:
-                    self.ready.append(self._write_waiting.pop(fd))
-
-                # Check for sleeping tasks
-                now = time.time()
-                while self.sleeping:
-                    if now > self.sleeping[0][0]:
-                        self.ready.append(heapq.heappop(self.sleeping)[2])
+        while (self.ready or self._queued or self.sleeping or self._read_waiting
+               or self._write_waiting or self._jobs or self._from_threads):
+            # Find the nearest deadline
+            if self.ready or self._queued:
+                timeout = 0  # Callbacks still waiting: only check for I/O
+            elif self.sleeping:
+                timeout = self.sleeping.next_deadline() - self.clock()
+                if timeout < 0:
+                    timeout = 0
+            else:
+                timeout = None  # Wait forever
+
+            # Wait fo I/O (and sleep)
+            if self._advance is None or not timeout:
+                events = self._poller.poll(timeout)
+            elif self._read_waiting or self._write_waiting or self._jobs:
+                # Simulated time with I/O pending: really wait, and
+                # only move the clock if nothing came in meanwhile
+                events = self._poller.poll(timeout)
+                if not events:
+                    self._advance(timeout)
+            else:
+                # Simulated time, nothing but timers: jump ahead
+                events = self._poller.poll(0)
+                self._advance(timeout)
+            for fd, mask in events:
+                if fd == self._waker.fileno():
+                    self._waker.clear()
+                    continue
+                idle = 0
+                if mask & EVENT_READ:
+                    if fd in self._read_waiting:
+                        self.ready.append(self._read_waiting.pop(fd))
+                    else:
+                        idle |= EVENT_READ
+                if mask & EVENT_WRITE:
+                    if fd in self._write_waiting:
+                        self.ready.append(self._write_waiting.pop(fd))
                     else:
-                        break
+                        idle |= EVENT_WRITE
+                reg = self._registered.get(fd)
+                if reg is None:
+                    continue  # Collected since the poll, see _collected()
+                idle &= reg[1]
+                if not idle:
+                    continue
+                if self._edge_triggered:
+                    reg[2] |= idle  # Won't be reported again; remember it
+                else:
+                    reg[1] &= ~idle  # Level-triggered would spin on it
+                    self._poller.modify(fd, reg[1])
 
-            while self.ready:
-                func = self.ready.popleft()
-                func()
+            # Check for sleeping tasks
+            now = self.clock()
+            earliest = self.sleeping.expire(now, self.ready)
+            if self.profiler is not None and earliest is not None:
+                self.profiler.lag(now - earliest)
+
+            while self._from_threads:
+                self.ready.append(self._from_threads.popleft())
+
+            # Run at most budget callbacks before polling I/O again, even
+            # if they keep rescheduling each other
+            queue = self._fair_batch() if self._groups else self.ready
+            if self.profiler is None:
+                budget = self.budget
+                while queue and budget:
+                    func = queue.popleft()
+                    func()
+                    budget -= 1
+            else:
+                self.profiler.run(queue, self.budget)
+
+    # Fair share: tasks started with new_task(coro, group=name) queue per
+    # group, and every other callback in the 'default' group. Groups take
+    # turns running up to weight callbacks each, so a flood in one group
+    # (say, freshly accepted connections) can't starve another (health
+    # checks). Without groups everything runs in plain FIFO order.
+    def add_group(self, name, weight=1):
+        if not self._groups:
+            self._groups['default'] = _RunGroup('default', 1)
+        group = self._groups.get(name)
+        if group is None:
+            group = self._groups[name] = _RunGroup(name, weight)
+        group.weight = weight
+        return group
+
+    def _fair_batch(self):
+        # Sort the newly ready callbacks into their groups, then pick this
+        # iteration's batch from those round-robin, weight at a time.
+        # Callbacks that become ready while it runs wait for the next one.
+        ready = self.ready
+        default = self._groups['default'].queue
+        while ready:
+            func = ready.popleft()
+            if type(func) is Task and func.group is not None:
+                func.group.queue.append(func)
+            else:
+                default.append(func)
+        active = [group for group in self._groups.values() if group.queue]
+        budget = self.budget
+        batch = deque()
+        while active and len(batch) < budget:
+            for group in active:
+                for _ in range(min(group.weight, len(group.queue), budget - len(batch))):
+                    batch.append(group.queue.popleft())
+            active = [group for group in active if group.queue]
+        self._queued = sum(len(group.queue) for group in active)
+        return batch
 
     # Coroutine-based functions
-    def new_task(self, coro):
-        self.ready.append(Task(coro))  # Wrapped coroutine
-
-    async def sleep(self, delay):
-        self.call_later(delay, self.current)
-        self.current = None
-        await switch()  # Switch to a new task
-
-    async def recv(self, sock, maxbytes):
-        self.read_wait(sock, self.current)
-        self.current = None
-        await switch()
-        return sock.recv(maxbytes)
-
-    async def send(self, sock, data):
-        self.write_wait(sock, self.current)
-        self.current = None
-        await switch()
-        return sock.send(data)
-
-    async def accept(self, sock):
-        self.read_wait(sock, self.current)
-        self.current = None
-        await switch()
-        return sock.accept()
+    def new_task(self, coro, group=None):
+        task = Task(coro, self)  # Wrapped coroutine
+        if group is not None:
+            task.group = self._groups[group]  # See add_group()
+        self.ready.append(task)
+        self._tasks.add(task)
+        return task
+
+    # Introspection: where is every live task, and why?
+    def task_states(self):
+        # One dict per unfinished task: name, state (ready, sleeping,
+        # io-wait, queue-wait, join, drain, wait or executor), what it
+        # waits on, age in seconds and its await stack, outermost first
+        now = self.clock()
+        states = []
+        for task in list(self._tasks):
+            if task.done:
+                continue
+            state, on = 'ready', None
+            trap = task._parked
+            if trap is not None:
+                kind = trap[0]
+                if kind == 'sleep':
+                    state, on = 'sleeping', f'wakes in {task._timer.deadline - now:.3f}s'
+                elif kind == 'read_wait' or kind == 'write_wait':
+                    state, on = 'io-wait', f'fd {_fileno(trap[1])} {kind[:-5]}'
+                elif kind == 'future':
+                    state, on = 'executor', trap[1]
+                else:
+                    owner = trap[3]
+                    on = owner
+                    if isinstance(owner, AsyncQueue):
+                        state = 'queue-wait'
+                    elif isinstance(owner, Task):
+                        state, on = 'join', owner.coro
+                    elif isinstance(owner, StreamWriter):
+                        state = 'drain'
+                    else:
+                        state = 'wait'
+            states.append({
+                'task': task,
+                'name': task.coro.__qualname__,
+                'state': state,
+                'on': on,
+                'age': now - task.created,
+                'stack': _await_stack(task.coro),
+            })
+        states.sort(key=lambda state: state['age'], reverse=True)
+        return states
+
+    def dump_tasks(self, file=None):
+        file = file if file is not None else sys.stderr
+        states = self.task_states()
+        print(f'--- {len(states)} tasks, {len(self.ready)} callbacks ready ---', file=file)
+        for state in states:
+            on = f' on {state["on"]}' if state['on'] is not None else ''
+            print(f'{state["name"]} [{state["state"]}]{on}, age {state["age"]:.1f}s', file=file)
+            for filename, lineno, name in state['stack']:
+                print(f'    {filename}:{lineno} in {name}', file=file)
+
+    def dump_on_signal(self, signo=signal.SIGUSR1, file=None):
+        # kill -USR1 <pid> prints every task's state. The dump runs as a
+        # callback, between two others, so it sees consistent state and
+        # the loop carries on afterwards.
+        signal.signal(signo, lambda signo, frame: self.call_soon_threadsafe(lambda: self.dump_tasks(file)))
+
+    # Trap handlers. Task.__call__ hands them what the coroutine yielded.
+    # ('park', waiters, deadline, owner): owner is the queue, task or
+    # writer the waiters belong to, for task_states() only.
+    # They return SUSPEND after parking the task somewhere, or else the
+    # value to resume it with right away. A parked task remembers its
+    # trap in task._parked, which is all _unpark() needs to take it back
+    # out again for Task.cancel() and timeouts.
+    def _trap_current(self, task, trap):
+        return task
+
+    def _trap_sleep(self, task, trap):
+        task._timer = self.call_later(trap[1], task)
+        task._parked = trap
+        return SUSPEND
+
+    def _trap_read_wait(self, task, trap):
+        self._wait(trap[1], EVENT_READ, self._read_waiting, task)
+        return self._park_until(task, trap, trap[2])
+
+    def _trap_write_wait(self, task, trap):
+        self._wait(trap[1], EVENT_WRITE, self._write_waiting, task)
+        return self._park_until(task, trap, trap[2])
+
+    def _trap_park(self, task, trap):
+        trap[1].append(task)  # Whoever pops it off puts it back in ready
+        return self._park_until(task, trap, trap[2])
+
+    def _trap_future(self, task, trap):
+        # Wait for a concurrent.futures.Future from another thread/process
+        self._jobs += 1
+
+        def wake():
+            self._jobs -= 1
+            if task._parked is trap:
+                task._parked = None
+                self.ready.append(task)
+
+        trap[1].add_done_callback(lambda future: self.call_soon_threadsafe(wake))
+        task._parked = trap
+        return SUSPEND
+
+    def _park_until(self, task, trap, deadline):
+        task._parked = trap
+        if deadline is not None:
+            # Tied to this trap: by the time it runs, the task may have
+            # been woken by I/O in the same iteration and parked anew
+            task._timer = self.call_at(deadline, lambda: task._timed_out(trap))
+        return SUSPEND
+
+    def _unpark(self, task):
+        # Undo the parking trap. False if the task was already woken.
+        trap = task._parked
+        kind = trap[0]
+        if kind == 'park':
+            try:
+                trap[1].remove(task)
+            except ValueError:
+                return False
+        elif kind == 'sleep':
+            if not task._timer.active():
+                return False
+        elif kind == 'future':
+            trap[1].cancel()  # Only helps if the job has not started
+        else:
+            waiting = self._read_waiting if kind == 'read_wait' else self._write_waiting
+            fd = _fileno(trap[1])
+            if waiting.get(fd) is not task:
+                return False
+            del waiting[fd]
+        return True
+
+    # The operations below only build trap requests; whichever scheduler
+    # runs the awaiting task serves them. They are bare generators rather
+    # than async defs so that a parked task holds one frame less.
+    # Socket operations expect non-blocking sockets. They try the call
+    # first and only park the task when the kernel has nothing for us
+    # yet. timeout (seconds) covers the whole call and raises TimeoutError.
+    # Traps carry it as a deadline on the serving scheduler's clock.
+    @types.coroutine
+    def sleep(self, delay):
+        yield ('sleep', delay)
+
+    @types.coroutine
+    def park(self, waiters, timeout=None):
+        # Wait on a deque/list of tasks until someone pops us off it
+        # and puts us back in ready
+        yield ('park', waiters, (yield from _deadline(timeout)), None)
+
+    @types.coroutine
+    def recv(self, sock, maxbytes, timeout=None):
+        deadline = yield from _deadline(timeout)
+        while True:
+            try:
+                return sock.recv(maxbytes)
+            except BlockingIOError:
+                pass
+            yield ('read_wait', sock, deadline)
+
+    @types.coroutine
+    def recv_into(self, sock, buffer, nbytes=0, timeout=None):
+        # Read straight into a bytearray/memoryview, no intermediate bytes
+        deadline = yield from _deadline(timeout)
+        while True:
+            try:
+                return sock.recv_into(buffer, nbytes)
+            except BlockingIOError:
+                pass
+            yield ('read_wait', sock, deadline)
+
+    @types.coroutine
+    def send(self, sock, data, timeout=None):
+        deadline = yield from _deadline(timeout)
+        while True:
+            try:
+                return sock.send(data)
+            except BlockingIOError:
+                pass
+            yield ('write_wait', sock, deadline)
+
+    @types.coroutine
+    def sendmsg(self, sock, buffers, timeout=None):
+        # Scatter/gather write: buffers go out in one syscall, unjoined
+        deadline = yield from _deadline(timeout)
+        while True:
+            try:
+                return sock.sendmsg(buffers)
+            except BlockingIOError:
+                pass
+            yield ('write_wait', sock, deadline)
+
+    async def sendall(self, sock, data):
+        # Keep sending until the peer has taken all of data
+        view = memoryview(data)
+        while view:
+            view = view[await self.send(sock, view):]
+
+    @types.coroutine
+    def accept(self, sock, timeout=None):
+        deadline = yield from _deadline(timeout)
+        while True:
+            try:
+                client, addr = sock.accept()
+                client.setblocking(False)
+                return client, addr
+            except BlockingIOError:
+                pass
+            yield ('read_wait', sock, deadline)
+
+    # Blocking work runs in a thread pool. Finished jobs hand their task
+    # back with call_soon_threadsafe(), so the loop wakes up right away.
+    async def run_in_executor(self, func, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor()
+        return await self._offload(self._executor, func, args)
+
+    async def run_in_process(self, func, *args):
+        # CPU-bound work in other processes. func, args and the result must
+        # pickle; the pool's own feeder threads do that, not the loop.
+        # Beyond process_limit calls in flight, callers wait their turn.
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor()
+        while self._in_process >= self.process_limit:
+            try:
+                await self.park(self._process_waiting)
+            except BaseException:
+                # We may have been handed a free slot; pass it on
+                if self._in_process < self.process_limit and self._process_waiting:
+                    self.ready.append(self._process_waiting.popleft())
+                raise
+        # The slot is held until the job is done, not just until the caller
+        # stops waiting: a cancelled caller's job may well be running
+        future = self._process_pool.submit(func, *args)
+        self._in_process += 1
+        future.add_done_callback(lambda future: self.call_soon_threadsafe(self._process_done))
+        await _trap('future', future)
+        return future.result()
+
+    def _process_done(self):
+        self._in_process -= 1
+        if self._process_waiting:
+            self.ready.append(self._process_waiting.popleft())
+
+    async def _offload(self, executor, func, args):
+        # A cancelled caller stops waiting; the job itself can only be
+        # dropped if it has not started yet
+        future = executor.submit(func, *args)
+        await _trap('future', future)
+        return future.result()
+
+
+def _await_stack(coro):
+    # (filename, lineno, function) for coro and everything it awaits
+    stack = []
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        stack.append((frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return stack
+
+
+@types.coroutine
+def _deadline(timeout):
+    # timeout seconds from now on the clock of the awaiting task's scheduler
+    if timeout is None:
+        return None
+    task = yield ('current',)
+    return task.sched.clock() + timeout
+
+
+class Cancelled(BaseException):
+    # Thrown into a task by Task.cancel(). Not an Exception, so that
+    # handlers catching Exception don't swallow it by accident.
+    pass
+
 
 # Class that wraps a coroutine--making it look like a callback
 class Task:
-    def __init__(self, coro):
+    # Slots: an idle connection is mostly its Task, so keep it small
+    __slots__ = ('coro', 'sched', 'group', 'created', 'done', '_result', '_exception',
+                 '_retrieved', '_callbacks', '_parked', '_timer', '_throw', '__weakref__')
+
+    def __init__(self, coro, sched):
         self.coro = coro  # "Wrapped coroutine"
+        self.sched = sched  # Scheduler that runs it and serves its traps
+        self.group = None  # Fair-share run group, if any
+        self.created = sched.clock()
+        self.done = False
+        self._result = None
+        self._exception = None
+        self._retrieved = False  # Has anyone looked at the outcome?
+        self._callbacks = None  # Run (tasks resumed) when done; list on demand
+        self._parked = None  # Trap the task is parked on
+        self._timer = None  # Wakeup or timeout of that trap
+        self._throw = None  # Exception to raise in the coroutine next
 
     # Make it look like a callback
     def __call__(self):
+        sched = self.sched
+        self._parked = None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        value = None
         try:
-            # Driving the coroutine as before
-            sched.current = self
-            self.coro.send(None)
-            if sched.current:
-                sched.ready.append(self)
-        except StopIteration:
-            pass
+            # Run the coroutine until it blocks. Each trap it yields is
+            # served on the spot; None is a plain switch().
+            while True:
+                if self._throw is not None:
+                    exc, self._throw = self._throw, None
+                    trap = self.coro.throw(exc)
+                else:
+                    trap = self.coro.send(value)
+                if trap is None:
+                    sched.ready.append(self)  # Back of the line
+                    return
+                value = sched._traps[trap[0]](self, trap)
+                if value is SUSPEND:
+                    if self._throw is None or not sched._unpark(self):
+                        return
+                    # Cancelled while it was running: don't even park
+                    self._parked = None
+                    if self._timer is not None:
+                        self._timer.cancel()
+                        self._timer = None
+                    value = None
+        except StopIteration as e:
+            self._finish(e.value, None)
+        except (Exception, Cancelled) as e:
+            self._finish(None, e)  # Fails this task, not the whole loop
+
+    def cancel(self):
+        # Raise Cancelled inside the task: right away if it is parked,
+        # otherwise at its next suspension point
+        return self._interrupt(Cancelled())
+
+    def cancelled(self):
+        return self.done and isinstance(self._exception, Cancelled)
 
+    def _timed_out(self, trap):
+        if self._parked is trap:
+            self._interrupt(TimeoutError(), False)
+
+    def _interrupt(self, exc, always=True):
+        if self.done:
+            return False
+        if self._parked is not None and self.sched._unpark(self):
+            self._parked = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._throw = exc
+            self.sched.ready.append(self)
+            return True
+        if always:
+            self._throw = exc  # Already on its way to ready; deliver then
+            return True
+        return False
+
+    def _finish(self, result, exception):
+        self.done = True
+        self._result = result
+        self._exception = exception
+        self.sched._tasks.discard(self)
+        if self._callbacks:
+            self.sched.ready.extend(self._callbacks)
+            self._callbacks = None
+
+    def result(self):
+        if not self.done:
+            raise RuntimeError('Task is not done')
+        self._retrieved = True
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        if not self.done:
+            raise RuntimeError('Task is not done')
+        self._retrieved = True
+        return self._exception
+
+    def add_done_callback(self, func):
+        # func() runs once the task is done (soon, if it already is)
+        if self.done:
+            self.sched.ready.append(func)
+        else:
+            self._waiters().append(func)
+
+    def remove_done_callback(self, func):
+        if self._callbacks and func in self._callbacks:
+            self._callbacks.remove(func)
+
+    def _waiters(self):
+        if self._callbacks is None:
+            self._callbacks = []
+        return self._callbacks
 
-class Awaitable:
     def __await__(self):
-        yield
+        # Joiners are woken directly when the task finishes, no polling
+        if not self.done:
+            yield ('park', self._waiters(), None, self)
+        return self.result()
+
+    def __del__(self):
+        if (self._exception is not None and not self._retrieved
+                and not isinstance(self._exception, Cancelled)):
+            print(f'Task exception was never retrieved: {self.coro!r}', file=sys.stderr)
+            traceback.print_exception(self._exception)
+
+
+FIRST_COMPLETED = 'FIRST_COMPLETED'
+FIRST_EXCEPTION = 'FIRST_EXCEPTION'
+ALL_COMPLETED = 'ALL_COMPLETED'
+
+
+async def gather(*aws):
+    # Run coroutines/tasks concurrently and return their results in order.
+    # The first exception propagates; the other tasks keep running.
+    sched = (await current_task()).sched
+    tasks = [aw if isinstance(aw, Task) else sched.new_task(aw) for aw in aws]
+    return [await task for task in tasks]
+
+
+async def wait(tasks, return_when=ALL_COMPLETED):
+    # Returns (done, pending) sets. Never raises the tasks' exceptions.
+    tasks = set(tasks)
+    pending = {task for task in tasks if not task.done}
+    while pending:
+        if return_when == FIRST_COMPLETED and len(pending) < len(tasks):
+            break
+        if return_when == FIRST_EXCEPTION and any(
+                task._exception is not None for task in tasks - pending):
+            break
+        if return_when == ALL_COMPLETED:
+            # Only the last one to finish matters; wait on any of them
+            joined = next(iter(pending))
+            await _trap('park', joined._waiters(), None, joined)
+        else:
+            # Whichever finishes first wakes us, exactly once
+            waiters = []
+
+            def wake():
+                if waiters:
+                    waiter = waiters.pop()
+                    waiter.sched.ready.append(waiter)
+
+            for task in pending:
+                task.add_done_callback(wake)
+            try:
+                await _trap('park', waiters, None, None)
+            finally:
+                for task in pending:
+                    task.remove_done_callback(wake)
+        pending = {task for task in pending if not task.done}
+    return tasks - pending, pending
+
+
+SUSPEND = 'suspend'  # Returned by trap handlers: the task is parked
 
 
+@types.coroutine
+def _trap(*trap):
+    # Hand a request such as ('read_wait', sock, deadline) to Task.__call__
+    return (yield trap)
+
+
+@types.coroutine
 def switch():
-    return Awaitable()
+    # Let other tasks run, then carry on. A bare generator: no Awaitable
+    # object or __await__ call per switch.
+    yield
+
+
+async def current_task():
+    return await _trap('current')
 
 
 sched = Scheduler()  # Background scheduler object
+buffers = BufferPool()  # Shared receive buffers
 
 
 # ----------------
 
 class AsyncQueue:
-    def __init__(self):
+    def __init__(self, maxsize=0):
         self.items = deque()
-        self.waiting = deque()
+        self.waiting = deque()  # Getters waiting for an item
+        self.maxsize = maxsize  # 0 means unbounded
+        self.putters = deque()  # Putters waiting for room (backpressure)
 
     async def put(self, item):
+        while self.maxsize and len(self.items) >= self.maxsize:
+            await self._wait_for_room()
         self.items.append(item)
         if self.waiting:
-            sched.ready.append(self.waiting.popleft())
+            _wake(self.waiting)
+
+    async def get(self, timeout=None):
+        deadline = await _deadline(timeout)
+        while not self.items:
+            await self._wait_for_item(deadline)
+        item = self.items.popleft()
+        if self.putters:
+            _wake(self.putters)
+        return item
 
-    async def get(self):
-        if not self.items:
-            self.waiting.append(sched.current)  # Put myself to sleep
-            sched.current = None  # "Disappear"
-            await switch()  # Switch to another task
-        return self.items.popleft()
+    async def put_many(self, items):
+        # Append in bulk, waking only as many getters as items went in
+        items = list(items)
+        start = 0
+        while start < len(items):
+            while self.maxsize and len(self.items) >= self.maxsize:
+                await self._wait_for_room()
+            end = len(items)
+            if self.maxsize:
+                end = min(end, start + self.maxsize - len(self.items))
+            self.items.extend(islice(items, start, end))
+            for _ in range(min(end - start, len(self.waiting))):
+                _wake(self.waiting)
+            start = end
+
+    async def get_many(self, max_items):
+        # Up to max_items in one wake-up (at least one; waits if empty)
+        while not self.items:
+            await self._wait_for_item()
+        batch = [self.items.popleft() for _ in range(min(max_items, len(self.items)))]
+        for _ in range(min(len(batch), len(self.putters))):
+            _wake(self.putters)
+        return batch
+
+    # Bare generators, like Scheduler.park(): one frame less per waiter
+    @types.coroutine
+    def _wait_for_item(self, deadline=None):
+        try:
+            yield ('park', self.waiting, deadline, self)  # Put myself to sleep
+        except BaseException:
+            # A put() may have woken us just before; pass it on
+            if self.items and self.waiting:
+                _wake(self.waiting)
+            raise
+
+    @types.coroutine
+    def _wait_for_room(self):
+        try:
+            yield ('park', self.putters, None, self)
+        except BaseException:
+            if len(self.items) < self.maxsize and self.putters:
+                _wake(self.putters)
+            raise
+
+
+def _wake(waiters):
+    # Resume the longest waiting task of a deque, on its own scheduler
+    task = waiters.popleft()
+    task.sched.ready.append(task)
+
+
+class IncompleteRead(EOFError):
+    # The peer closed the connection before a full read. partial holds
+    # what did arrive; expected is the byte count asked for, if any.
+    def __init__(self, partial, expected=None):
+        super().__init__(f'{len(partial)} bytes read, {expected if expected is not None else "more"} expected')
+        self.partial = partial
+        self.expected = expected
+
+
+class LimitOverrun(Exception):
+    pass
+
+
+class StreamReader:
+    # Buffered socket reader for framed protocols. Data is received with
+    # recv_into() straight into one bytearray; a read cursor marks what
+    # has been consumed, and the unread bytes are slid back to the front
+    # only when the tail runs short of room. readuntil() doesn't rescan
+    # what it has already searched, so long frames arriving in small
+    # pieces cost linear, not quadratic, time.
+    def __init__(self, sock, limit=65536, size=4096):
+        self.sock = sock
+        self.limit = limit  # Most bytes readuntil()/readline() buffer looking for a separator
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # Read cursor
+        self._end = 0  # End of the received data
+        self._scanned = 0  # readuntil() searched up to here already
+        self._eof = False
+
+    async def readuntil(self, separator=b'\n'):
+        # Everything up to and including separator
+        while True:
+            index = self._buffer.find(separator, self._scanned, self._end)
+            if index >= 0:
+                return self._take(index + len(separator) - self._start)
+            # A separator may straddle what arrives next
+            self._scanned = max(self._start, self._end - len(separator) + 1)
+            if self._end - self._start > self.limit:
+                raise LimitOverrun(f'separator not found in {self.limit} bytes')
+            if not await self._receive(self._end - self._start + 1):
+                raise IncompleteRead(self._take(self._end - self._start))
+
+    async def readline(self):
+        # Like readuntil(b'\n'), except that at EOF it returns whatever is
+        # left (b'' once nothing is)
+        try:
+            return await self.readuntil(b'\n')
+        except IncompleteRead as e:
+            return e.partial
+
+    async def readexactly(self, n):
+        while self._end - self._start < n:
+            if not await self._receive(n):
+                raise IncompleteRead(self._take(self._end - self._start), n)
+        return self._take(n)
+
+    def _take(self, n):
+        data = bytes(self._view[self._start:self._start + n])
+        self._start += n
+        if self._start == self._end:
+            self._start = self._end = 0  # Empty: start over at the front
+        self._scanned = self._start
+        return data
+
+    async def _receive(self, need):
+        # One recv_into() into the free tail, making room for need unread
+        # bytes in total first. False at EOF.
+        if self._eof:
+            return False
+        self._make_room(need)
+        while True:
+            try:
+                nbytes = self.sock.recv_into(self._view[self._end:])
+                break
+            except BlockingIOError:
+                await _trap('read_wait', self.sock, None)
+        if not nbytes:
+            self._eof = True
+            return False
+        self._end += nbytes
+        return True
+
+    def _make_room(self, need):
+        start, end = self._start, self._end
+        unread = end - start
+        size = len(self._buffer)
+        if start and size - end < max(need - unread, size // 4):
+            # Compact: slide the unread bytes to the front
+            self._view[:unread] = self._view[start:end]
+            self._scanned -= start
+            self._start, self._end = 0, unread
+        if size - self._end < need - unread:
+            # Still too small: grow, at least doubling
+            buffer = bytearray(max(2 * size, need))
+            buffer[:unread] = self._view[self._start:self._end]
+            self._view.release()
+            self._buffer, self._view = buffer, memoryview(buffer)
+            self._scanned -= self._start
+            self._start, self._end = 0, unread
+
+
+class StreamWriter:
+    # Buffered socket writer. Data queued by write() goes out with one
+    # sendmsg() (writev) at the end of the loop turn, so small writes
+    # coalesce. A task writing faster than the peer reads is suspended
+    # once more than high_water bytes are queued and resumed when the
+    # buffer has drained to low_water.
+    def __init__(self, sock, high_water=65536, low_water=16384):
+        self.sock = sock
+        self.high_water = high_water
+        self.low_water = low_water
+        self._chunks = deque()
+        self._size = 0  # Bytes queued
+        self._pending = False  # Flush scheduled or waiting for writability
+        self._paused = deque()  # Writers held back by the high watermark
+        self._flushing = deque()  # Tasks waiting for an empty buffer
+        self._error = None
+        self._sched = None  # The writing task's scheduler, on first write
+
+    async def write(self, data):
+        # bytes are queued as they are. Anything else gets copied, since
+        # the caller may reuse it (e.g. a view into a pooled buffer).
+        if self._error:
+            raise self._error
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        if not data:
+            return
+        if self._sched is None:
+            self._sched = (await current_task()).sched
+        self._chunks.append(data)
+        self._size += len(data)
+        if not self._pending:
+            self._pending = True
+            self._sched.call_soon(self._flush)
+        while self._size > self.high_water and not self._error:
+            await _trap('park', self._paused, None, self)  # Backpressure
+        if self._error:
+            raise self._error
+
+    async def writelines(self, chunks):
+        # Several chunks at once. With nothing queued ahead of them they go
+        # straight out in one sendmsg(), views and all, and only what the
+        # kernel doesn't take right away gets copied and queued.
+        if self._error:
+            raise self._error
+        if self._chunks or len(chunks) > IOV_MAX:
+            for chunk in chunks:
+                await self.write(chunk)
+            return
+        try:
+            sent = self.sock.sendmsg(chunks)
+        except BlockingIOError:
+            sent = 0
+        except OSError as e:
+            self._error = e
+            raise
+        for chunk in chunks:
+            if sent >= len(chunk):
+                sent -= len(chunk)
+                continue
+            await self.write(memoryview(chunk)[sent:] if sent else chunk)
+            sent = 0
+
+    async def flush(self):
+        # Wait until everything queued has been sent
+        while self._chunks and not self._error:
+            await _trap('park', self._flushing, None, self)
+        if self._error:
+            raise self._error
+
+    async def close(self):
+        try:
+            await self.flush()
+        finally:
+            if self._sched is None:
+                self._sched = (await current_task()).sched  # Never written to
+            self._sched.unregister(self.sock)
+            self.sock.close()
+
+    def _flush(self):
+        self._pending = False
+        while self._chunks:
+            try:
+                sent = self.sock.sendmsg(list(islice(self._chunks, IOV_MAX)))
+            except BlockingIOError:
+                self._pending = True
+                self._sched.write_wait(self.sock, self._flush)
+                break
+            except OSError as e:
+                # Peer is gone. Fail the writers rather than the loop.
+                self._error = e
+                self._chunks.clear()
+                self._size = 0
+                break
+            self._size -= sent
+            while sent:
+                chunk = self._chunks[0]
+                if sent < len(chunk):
+                    self._chunks[0] = memoryview(chunk)[sent:]
+                    break
+                sent -= len(chunk)
+                self._chunks.popleft()
+        if self._paused and self._size <= self.low_water:
+            self._sched.ready.extend(self._paused)
+            self._paused.clear()
+        if self._flushing and not self._chunks:
+            self._sched.ready.extend(self._flushing)
+            self._flushing.clear()
 
 
 # Coroutine-based tasks
 async def producer(q, count):
+    sched = (await current_task()).sched
     for n in range(count):
         print('Producing', n)
         await q.put(n)
@@ -166,11 +1460,6 @@ async def consumer(q):
     print('Consumer done')
 
 
-q = AsyncQueue()
-sched.new_task(producer(q, 10))
-sched.new_task(consumer(q))
-
-
 # Call-back based tasks
 def countdown(n):
     if n > 0:
@@ -189,26 +1478,153 @@ def countup(stop):
     _run(0)
 
 
-sched.call_soon(lambda: countdown(5))
-sched.call_soon(lambda: countup(20))
-
-
-async def tcp_server(addr):
+def tcp_listener(addr, backlog=128, reuse_port=False):
     sock = socket(AF_INET, SOCK_STREAM)
+    sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if reuse_port:
+        # Several processes bind the same port; the kernel spreads
+        # incoming connections across their listen queues
+        sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
     sock.bind(addr)
-    sock.listen(1)
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+async def tcp_server(addr, backlog=128, sock=None):
+    if sock is None:
+        sock = tcp_listener(addr, backlog)
+    sched = (await current_task()).sched  # Whichever scheduler serves us
     while True:
         client, addr = await sched.accept(sock)
         sched.new_task(echo_handler(client))
 
 
 async def echo_handler(sock):
-    while True:
-        data = await sched.recv(sock=sock, maxbytes=1000)
-        if not data:
-            break
-        await sched.send(sock=sock, data=b'Got:' + data)
-    print('Connection closed')
-    sock.close()
-sched.new_task(tcp_server(("", 3000)))
-sched.run()
+    sched = (await current_task()).sched
+    writer = StreamWriter(sock)
+    buffer = buffers.acquire()
+    view = memoryview(buffer)
+    try:
+        while True:
+            nbytes = await sched.recv_into(sock, view)
+            if not nbytes:
+                break
+            await writer.writelines([b'Got:', view[:nbytes]])
+    finally:
+        # Also on a reset or cancel: the buffer goes back to the pool and
+        # the socket leaves the poller and gets closed
+        view.release()
+        buffers.release(buffer)
+        print('Connection closed')
+        await writer.close()
+
+
+# Multi-core: one process per core, each with its own Scheduler
+def serve_forked(addr, workers=None, backlog=128, grace=10.0):
+    # Fork workers that each accept on their own SO_REUSEPORT listener.
+    # SIGTERM/SIGINT to the parent shut them down gracefully, a second one
+    # right away. Returns once all exited: True if they all exited cleanly.
+    pids = []
+
+    def stop(signo, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    # Handlers go in first and the signals are held back until every
+    # worker is forked: one arriving mid-loop would otherwise kill the
+    # parent and orphan the workers forked so far
+    signals = {signal.SIGTERM, signal.SIGINT}
+    for signo in signals:
+        signal.signal(signo, stop)
+    signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+    try:
+        for _ in range(workers or os.cpu_count()):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    _serve_worker(addr, backlog, grace)
+                    status = 0
+                except BaseException:
+                    traceback.print_exc()
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(status)
+            pids.append(pid)
+    except BaseException:
+        stop(None, None)
+        raise
+    finally:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+    clean = True
+    for pid in pids:
+        code = os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+        if code:
+            print(f'Worker {pid} exited with status {code}', file=sys.stderr)
+            clean = False
+    return clean
+
+
+def _serve_worker(addr, backlog, grace):
+    sched = Scheduler()  # Never share the parent's epoll instance
+    listener = tcp_listener(addr, backlog, reuse_port=True)
+    sched.new_task(tcp_server(addr, sock=listener))
+
+    # Signals land on a socketpair the loop is polling, so they wake it.
+    # Only SIGTERM stops a worker. Ctrl-C sends SIGINT to the whole
+    # process group, and the parent forwards it as SIGTERM already: a
+    # worker acting on both would take the second one for "kill now".
+    wakeup, notify = socketpair()
+    wakeup.setblocking(False)
+    notify.setblocking(False)
+    signal.set_wakeup_fd(notify.fileno())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signo, frame: None)
+    sched.dump_on_signal()  # kill -USR1 <worker pid> lists its tasks
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM, signal.SIGINT})
+
+    def on_signal():
+        # The wakeup fd gets one byte (the signal number) for every signal
+        # with a Python handler, SIGUSR1 from dump_on_signal() included.
+        # Only SIGTERM means shut down.
+        try:
+            signums = wakeup.recv(64)
+        except BlockingIOError:
+            signums = b''
+        if signal.SIGTERM in signums:
+            shutdown()
+        else:
+            sched.read_wait(wakeup, on_signal)
+
+    def shutdown():
+        # Stop accepting and let open connections finish. run() returns
+        # once they have; after grace seconds SIGALRM ends it regardless.
+        # A second signal kills the worker right away.
+        for sock in (listener, wakeup):
+            sched.unregister(sock)
+            sock.close()
+        signal.set_wakeup_fd(-1)
+        notify.close()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.alarm(max(1, round(grace)))
+
+    sched.read_wait(wakeup, on_signal)
+    sched.run()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        # python 17_io_scheduler.py WORKERS  -> echo server on every core
+        sys.exit(0 if serve_forked(("", 3000), workers=int(sys.argv[1])) else 1)
+    q = AsyncQueue()
+    sched.new_task(producer(q, 10))
+    sched.new_task(consumer(q))
+    sched.call_soon(lambda: countdown(5))
+    sched.call_soon(lambda: countup(20))
+    sched.new_task(tcp_server(("", 3000)))
+    sched.run()
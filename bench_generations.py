@@ -0,0 +1,297 @@
+# Microbenchmarks for every Scheduler generation (02 through 17)
+#
+# Each file is loaded without its demo: only imports, classes, functions
+# and plain assignments are executed. time is swapped for a virtual clock
+# (generations that take an injected clock get a VirtualClock instead),
+# so sleeps and timers cost nothing, and print does nothing. Whatever a
+# generation doesn't support is reported as None; a generation that
+# breaks under a workload is reported with its error.
+#
+#   python bench_generations.py [--scale 1.0] [--json results.json]
+
+import argparse
+import ast
+import glob
+import json
+import os
+import platform
+import random
+import socket
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+KEEP = (ast.Import, ast.ImportFrom, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef, ast.Assign)
+
+
+class VirtualTime:
+    # Stands in for the time module inside a loaded generation. Sleeping
+    # just moves the clock forward.
+    perf_counter = staticmethod(time.perf_counter)
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    monotonic = time
+
+    def sleep(self, delay):
+        if delay > 0:
+            self.now += delay
+
+
+class Generation:
+    def __init__(self, path):
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        tree.body = [node for node in tree.body if isinstance(node, KEEP)]
+        self._code = compile(tree, path, 'exec')
+
+    def load(self):
+        # Fresh namespace each time: the early generations keep their state
+        # in a module-level sched
+        ns = {'__name__': f'gen_{self.name}'}
+        exec(self._code, ns)
+        ns['time'] = VirtualTime()
+        ns['print'] = lambda *args, **kwargs: None
+        return ns
+
+
+def new_scheduler(ns):
+    if 'VirtualClock' in ns:
+        return ns['Scheduler'](clock=ns['VirtualClock']())  # Takes its clock injected
+    return ns['sched']
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+# Workloads. Each takes a freshly loaded namespace and returns None when
+# the generation lacks what the workload needs.
+def bench_callbacks(ns, n):
+    # Self-rescheduling callbacks
+    sched = new_scheduler(ns)
+    if not hasattr(sched, 'call_soon'):
+        return None
+    chains = 10
+    left = [n // chains] * chains
+
+    def step(chain):
+        left[chain] -= 1
+        if left[chain] > 0:
+            sched.call_soon(lambda: step(chain))
+
+    for chain in range(chains):
+        sched.call_soon(lambda chain=chain: step(chain))
+    return n / timed(sched.run)
+
+
+def bench_switches(ns, n):
+    # Tasks that do nothing but yield to each other
+    sched = new_scheduler(ns)
+    if not hasattr(sched, 'new_task'):
+        return None
+    switch = ns.get('switch')
+    tasks = 10
+
+    def spin_gen(count):
+        for _ in range(count):
+            yield
+
+    async def spin(count):
+        for _ in range(count):
+            await switch()
+
+    for _ in range(tasks):
+        sched.new_task(spin(n // tasks) if switch else spin_gen(n // tasks))
+    return n / timed(sched.run)
+
+
+def bench_timers(ns, n, spread=60.0):
+    # Returns (inserts/s, fires/s). Timers are callbacks where call_later()
+    # exists, sleeping tasks otherwise (inserts not measurable there).
+    sched = new_scheduler(ns)
+    delays = [random.Random(1).uniform(0, spread) for _ in range(n)]
+    fired = [0]
+
+    def fire():
+        fired[0] += 1
+
+    if hasattr(sched, 'call_later'):
+        def insert():
+            for delay in delays:
+                sched.call_later(delay, fire)
+        inserted = timed(insert)
+        elapsed = timed(sched.run)
+        assert fired[0] == n
+        return n / inserted, n / elapsed
+    if hasattr(sched, 'sleep'):
+        async def sleeper(delay):
+            await sched.sleep(delay)
+            fire()
+
+        def run():
+            for delay in delays:
+                sched.new_task(sleeper(delay))
+            sched.run()
+        elapsed = timed(run)
+        assert fired[0] == n
+        return None, n / elapsed
+    return None, None
+
+
+def bench_queue(ns, n):
+    # Ping-pong over two queues; microseconds per round trip
+    if 'AsyncQueue' not in ns:
+        return None
+    sched = new_scheduler(ns)
+    Queue = ns['AsyncQueue']
+    requests, replies = Queue(), Queue()
+    if hasattr(sched, 'new_task'):
+        async def ping():
+            for i in range(n):
+                await requests.put(i)
+                await replies.get()
+
+        async def pong():
+            for _ in range(n):
+                await replies.put(await requests.get())
+
+        sched.new_task(ping())
+        sched.new_task(pong())
+    else:
+        # Callback queues: get(callback), callback(item or Result)
+        def ping(i):
+            if i < n:
+                requests.put(i)
+                replies.get(lambda item: ping(i + 1))
+
+        def pong():
+            def reply(item):
+                replies.put(item)
+                pong()
+            requests.get(reply)
+
+        sched.call_soon(lambda: ping(0))
+        sched.call_soon(pong)
+    return timed(sched.run) / n * 1e6
+
+
+def bench_echo(ns, n, clients=10):
+    # Requests/s through tcp_server/echo_handler over loopback
+    if 'tcp_server' not in ns or 'gather' not in ns:
+        return None
+    sched = ns['Scheduler']()  # Real poller: this one waits for sockets
+    listener = ns['tcp_listener'](('127.0.0.1', 0))
+    addr = listener.getsockname()
+    sched.new_task(ns['tcp_server'](addr, sock=listener))
+    message = b'ping'
+    reply = len(b'Got:' + message)
+
+    async def client(count):
+        sock = socket.create_connection(addr)
+        sock.setblocking(False)
+        for _ in range(count):
+            await sched.sendall(sock, message)
+            received = 0
+            while received < reply:
+                received += len(await sched.recv(sock, 64))
+        sock.close()
+
+    async def main():
+        await ns['gather'](*[client(n // clients) for _ in range(clients)])
+        sched.unregister(listener)  # Stops tcp_server so run() can return
+        listener.close()
+
+    sched.new_task(main())
+    return n / timed(sched.run)
+
+
+def run_generation(gen, scale):
+    def n(count):
+        return max(10, int(count * scale))
+
+    workloads = {
+        'callbacks_per_sec': lambda: bench_callbacks(gen.load(), n(200000)),
+        'switches_per_sec': lambda: bench_switches(gen.load(), n(200000)),
+        'timers': lambda: bench_timers(gen.load(), n(5000)),
+        'queue_round_trip_us': lambda: bench_queue(gen.load(), n(50000)),
+        'echo_requests_per_sec': lambda: bench_echo(gen.load(), n(20000)),
+    }
+    result = {}
+    for key, workload in workloads.items():
+        try:
+            value = workload()
+        except Exception as e:
+            value = {'error': f'{type(e).__name__}: {e}'}
+        if key == 'timers':
+            if isinstance(value, dict):
+                result['timer_inserts_per_sec'] = result['timer_fires_per_sec'] = value
+            else:
+                result['timer_inserts_per_sec'], result['timer_fires_per_sec'] = value
+        else:
+            result[key] = value
+    return result
+
+
+def generations(only=None):
+    # Files 02 through 17 that define a Scheduler
+    for path in sorted(glob.glob(os.path.join(HERE, '[0-9][0-9]_*.py'))):
+        gen = Generation(path)
+        if not 2 <= int(gen.name[:2]) <= 17 or (only and gen.name[:2] not in only):
+            continue
+        if 'Scheduler' in gen.load():
+            yield gen
+
+
+def format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, dict):
+        return 'error'
+    return f'{value:,.1f}' if value < 100 else f'{value:,.0f}'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply workload sizes')
+    parser.add_argument('--only', nargs='*', help='generation numbers, e.g. 16 17')
+    parser.add_argument('--json', metavar='PATH', help="write results as JSON ('-' for stdout)")
+    args = parser.parse_args()
+
+    results = {gen.name: run_generation(gen, args.scale) for gen in generations(args.only)}
+
+    if args.json:
+        report = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scale': args.scale,
+            'results': results,
+        }
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=2)
+            print()
+            return
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    columns = ['callbacks_per_sec', 'switches_per_sec', 'timer_inserts_per_sec',
+               'timer_fires_per_sec', 'queue_round_trip_us', 'echo_requests_per_sec']
+    headers = ['callbacks/s', 'switches/s', 'timer adds/s', 'timer fires/s', 'queue rtt us', 'echo req/s']
+    print(f'{"":18}' + ''.join(f'{header:>15}' for header in headers))
+    for name, result in results.items():
+        print(f'{name:18}' + ''.join(f'{format_value(result[column]):>15}' for column in columns))
+    for name, result in results.items():
+        for column in columns:
+            if isinstance(result[column], dict):
+                print(f'{name} {column}: {result[column]["error"]}')
+
+
+if __name__ == '__main__':
+    main()
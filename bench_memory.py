@@ -0,0 +1,60 @@
+# Memory benchmark: bytes per idle task
+#
+# Spawns N tasks that park right away, the way idle connections sit in
+# a server, and reports how much memory each one holds on to: its Task,
+# coroutine frame and whatever it is parked on.
+#
+#   python bench_memory.py [-n 100000]
+
+import argparse
+import gc
+import importlib
+import tracemalloc
+
+io_scheduler = importlib.import_module('17_io_scheduler')
+
+
+async def wait_queue(sched, q, task):
+    await q.get()  # Nothing ever arrives
+
+
+async def wait_timer(sched, q, task):
+    await sched.sleep(3600)
+
+
+async def wait_join(sched, q, task):
+    await task  # Never finishes either
+
+
+def bench(idle, n):
+    sched = io_scheduler.Scheduler()
+    q = io_scheduler.AsyncQueue()
+    task = sched.new_task(wait_queue(sched, q, None))
+    sched.ready.popleft()()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for _ in range(n):
+        sched.new_task(idle(sched, q, task))
+    # Run everything up to its first park. Not run(): that would wait for
+    # the sleepers.
+    while sched.ready:
+        sched.ready.popleft()()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=100000, help='number of idle tasks')
+    args = parser.parse_args()
+
+    print(f'{args.n} idle tasks')
+    for name, idle in (('queue', wait_queue), ('sleep', wait_timer), ('join', wait_join)):
+        print(f'{name:>6}: {bench(idle, args.n):8.1f} bytes/task')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# Timer store benchmark
+#
+# Models per-connection idle timeouts: lots of timers, most of them
+# cancelled before they fire. The clock is simulated, nothing sleeps.
+# (A hierarchical timing wheel used to be measured here too. Once heap
+# cancels were tombstones it lost on add, cancel and fire alike, and was
+# dropped.)
+#
+#   python bench_timers.py [-n 10000] [--cancel 0.95]
+
+import argparse
+import importlib
+import random
+import time
+
+io_scheduler = importlib.import_module('17_io_scheduler')
+
+
+def bench(store, deadlines, cancel_ratio, step):
+    start = time.perf_counter()
+    timers = [store.add(deadline, n) for n, deadline in enumerate(deadlines)]
+    added = time.perf_counter()
+
+    doomed = random.Random(0).sample(timers, int(len(timers) * cancel_ratio))
+    for timer in doomed:
+        timer.cancel()
+    cancelled = time.perf_counter()
+
+    # Drive the store the way Scheduler.run does, one wakeup at a time
+    ready = []
+    now = 0.0
+    while len(store):
+        now = max(now + step, store.next_deadline())
+        store.expire(now, ready)
+    fired = time.perf_counter()
+    assert len(ready) == len(timers) - len(doomed)
+
+    return {
+        'add/s': len(timers) / (added - start),
+        'cancel/s': len(doomed) / (cancelled - added) if doomed else 0.0,
+        'fire/s': len(ready) / (fired - cancelled) if ready else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=10000, help='number of timers')
+    parser.add_argument('--cancel', type=float, default=0.95, help='fraction cancelled')
+    parser.add_argument('--spread', type=float, default=60.0, help='max delay (seconds)')
+    parser.add_argument('--step', type=float, default=0.01, help='min loop wakeup interval')
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    deadlines = [rng.uniform(0, args.spread) for _ in range(args.n)]
+    stores = {
+        'heap': lambda: io_scheduler.TimerHeap(),
+    }
+    print(f'{args.n} timers, {args.cancel:.0%} cancelled, deadlines within {args.spread}s')
+    for name, make in stores.items():
+        result = bench(make(), deadlines, args.cancel, args.step)
+        print(f'{name:>6}: ' + '  '.join(f'{key} {value:12,.0f}' for key, value in result.items()))
+
+
+if __name__ == '__main__':
+    main()